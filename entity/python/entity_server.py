@@ -1,14 +1,11 @@
-import sys
 import socket
-import selectors
-import types
-import subprocess
-import time
 import os
-from datetime import datetime
 import secrets
 import base64
+import logging
 import sqlite3
+import ssl
+import struct
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.backends import default_backend
 from cryptography import x509
@@ -20,6 +17,7 @@ from cryptography.hazmat.primitives import padding as pad
 from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 import cryptography
+logger = logging.getLogger(__name__)
 READ_BYTES_NUM = 1024
 RSA_KEY_SIZE = 256
 SESSION_KEY_ID_SIZE = 8
@@ -38,10 +36,18 @@ SKEY_HANDSHAKE_2 = 31
 SKEY_HANDSHAKE_3 = 32
 SECURE_COMM_MSG = 33
 MAC_KEY_SIZE = 32
+AUTH_CONNECT_TIMEOUT = 2.0
 DATA_UPLOAD_REQ = 0
 DATA_DOWNLOAD_REQ = 1
 DATA_RESP = 2
 database_name = "file_system_manager.db"
+PURPOSE_KEY_ID_PLACEHOLDER = "00000000"
+AUTH_REQUEST_HEADER = struct.Struct(f">{NONCE_SIZE}s{NONCE_SIZE}sI")
+# Must match Auth's RSA/ECB/PKCS1PADDING cipher and SHA256withRSA signature.
+RSA_ENCRYPTION_PADDING = padding.PKCS1v15()
+RSA_SIGNATURE_PADDING = padding.PKCS1v15()
+CONFIG_KEYS = frozenset(("name", "purpose", "number_key", "auth_pubkey_path", "privkey_path",
+                         "auth_ip_address", "auth_port_number", "port_number", "ip_address", "network_protocol"))
 
 def load_config(path: str, config_dict: dict) -> None:
     """Loads configuration data from a file into a provided dictionary.
@@ -54,71 +60,80 @@ def load_config(path: str, config_dict: dict) -> None:
         FileNotFoundError: If the file at the given path does not exist.
         IOError: If the file is not readable.
     """
-    f = open(path, 'r')
-    while True:
-        line = f.readline()
-        if not line: break
-        index = line.split("=")[0]
-        content = line.split("=")[1].strip("\n")
-        if index == "name":
-            config_dict["name"] = content
-        elif index == "purpose":
-            config_dict["purpose"] = content
-        elif index == "number_key":
-            config_dict["number_key"] = content
-        elif index == "auth_pubkey_path":
-            config_dict["auth_pubkey_path"] = content
-        elif index == "privkey_path":
-            config_dict["privkey_path"] = content
-        elif index == "auth_ip_address":
-            config_dict["auth_ip_address"] = content
-        elif index == "auth_port_number":
-            config_dict["auth_port_number"] = content
-        elif index == "port_number":
-            config_dict["port_number"] = content
-        elif index == "ip_address":
-            config_dict["ip_address"] = content
-        elif index == "network_protocol":
-            config_dict["network_protocol"] = content
-        else:
-            break
-    f.close()
+    with open(path, 'r') as f:
+        for line in f:
+            index, _, content = line.partition("=")
+            if index in CONFIG_KEYS:
+                config_dict[index] = content.rstrip("\n")
+
+def check_crypto_acceleration() -> bool:
+    """Reports the OpenSSL build used for RSA/AES and whether the CPU offers AES instructions.
 
-def write_in_n_bytes(num_key: int, key_size: int) -> bytearray:
-    """Writes an integer into a byte array of specified size.
+    The OpenSSL linked by the cryptography package should be built without `no-asm`,
+    otherwise RSA, SHA256, and AES fall back to much slower generic C implementations.
+    CPU features are read from the `flags` line of /proc/cpuinfo on x86 and the
+    `Features` line on ARM.
+
+    Returns:
+        bool: False if the CPU is known to lack AES instructions, True otherwise.
+    """
+    logger.info("cryptography OpenSSL: %s", default_backend().openssl_version_text())
+    logger.info("ssl module OpenSSL: %s", ssl.OPENSSL_VERSION)
+    if "OPENSSL_ia32cap" in os.environ:
+        logger.info("OPENSSL_ia32cap override: %s", os.environ["OPENSSL_ia32cap"])
+    if not os.path.isfile("/proc/cpuinfo"):
+        return True
+    x86_flags = None
+    arm_features = None
+    with open("/proc/cpuinfo", 'r') as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            name = name.strip()
+            if name == "flags" and x86_flags is None:
+                x86_flags = set(value.split())
+            elif name == "Features" and arm_features is None:
+                arm_features = set(value.split())
+    if x86_flags is not None:
+        if "aes" not in x86_flags:
+            logger.warning("CPU does not report AES-NI, AES will run without hardware acceleration.")
+            return False
+        if "avx2" not in x86_flags:
+            logger.warning("CPU does not report AVX2, RSA will not use the fastest OpenSSL assembly paths.")
+    elif arm_features is not None:
+        if "aes" not in arm_features:
+            logger.warning("CPU does not report ARMv8 AES instructions, AES will run without hardware acceleration.")
+            return False
+    return True
+
+def write_in_n_bytes(num_key: int, key_size: int) -> bytes:
+    """Writes an integer into a big-endian byte string of specified size.
 
     Args:
         num_key (int): The integer to convert.
-        key_size (int): The size of the resulting byte array.
+        key_size (int): The size of the resulting byte string.
 
     Returns:
-        bytearray: A byte array representing the integer.
+        bytes: A byte string representing the integer.
     """
-    buffer = bytearray(key_size)
-    for i in range(key_size):
-        buffer[i] = num_key >> 8*(key_size-i-1)
-    return buffer
+    return int(num_key).to_bytes(key_size, 'big')
 
-def num_to_var_length_int(num: int) -> bytearray:
-    """Converts an integer to a variable length byte array.
+def num_to_var_length_int(num: int) -> bytes:
+    """Converts an integer to a variable length byte string.
 
     Args:
         num (int): The integer to convert.
 
     Returns:
-        bytearray: A variable length byte array representing the integer.
+        bytes: A variable length byte string representing the integer.
     """
-    var_buf_size = 1
-    buffer = bytearray(4)
-    while (num > 127):
-        buffer[var_buf_size - 1] = 128 | num & 127
-        var_buf_size += 1
+    if num < 128:
+        return bytes((num,))
+    buffer = bytearray()
+    while num > 127:
+        buffer.append(128 | num & 127)
         num >>= 7
-    buffer[var_buf_size - 1] = num
-    buf = bytearray(var_buf_size)
-    for i in range(var_buf_size):
-        buf[i] = buffer[i]
-    return buf
+    buffer.append(num)
+    return bytes(buffer)
 
 def var_length_int_to_num(buffer: bytearray) -> tuple:
     """Converts a variable length byte array back to an integer.
@@ -220,10 +235,8 @@ def symmetric_decrypt_hmac(key_dir: dict, enc_buf: bytes, hmac_buf: bytes) -> by
     h.update(bytes(enc_buf))
     hmac_tag = h.finalize()
     if hmac_tag != hmac_buf:
-        print("Failed for verifying the data")
-        exit()
-    else:
-        print("Success for verifying the data")
+        raise ValueError("Failed for verifying the data")
+    logger.debug("Success for verifying the data")
     iv = enc_buf[:IV_SIZE]
     cipher = Cipher(algorithms.AES128(key_dir["cipher_key"]),modes.CBC(bytes(iv)))
     decryptor = cipher.decryptor()
@@ -242,7 +255,7 @@ def load_pubkey(key_dir: str) -> rsa.RSAPublicKey:
         rsa.RSAPublicKey: The loaded RSA public key.
     """
     with open(key_dir, 'rb') as pem_inn:
-        public_key = (x509.load_pem_x509_certificate(pem_inn.read(), default_backend)).public_key()
+        public_key = x509.load_pem_x509_certificate(pem_inn.read()).public_key()
     return public_key
 
 def load_privkey(key_dir: str) -> rsa.RSAPrivateKey:
@@ -268,7 +281,7 @@ def asymmetric_encrypt(message: bytes, pubkey: rsa.RSAPublicKey) -> bytes:
     Returns:
         bytes: The encrypted message.
     """
-    ciphertext = pubkey.encrypt(bytes(message),padding.PKCS1v15())
+    ciphertext = pubkey.encrypt(bytes(message), RSA_ENCRYPTION_PADDING)
     return ciphertext
 
 def asymmetric_decrypt(message: bytes, privkey: rsa.RSAPrivateKey) -> bytes:
@@ -281,7 +294,7 @@ def asymmetric_decrypt(message: bytes, privkey: rsa.RSAPrivateKey) -> bytes:
     Returns:
         bytes: The decrypted message.
     """
-    plaintext = privkey.decrypt(message, padding.PKCS1v15())
+    plaintext = privkey.decrypt(bytes(message), RSA_ENCRYPTION_PADDING)
     return plaintext
 
 def sha256_sign(message: bytes, privkey: rsa.RSAPrivateKey) -> bytes:
@@ -294,7 +307,7 @@ def sha256_sign(message: bytes, privkey: rsa.RSAPrivateKey) -> bytes:
     Returns:
         bytes: The digital signature.
     """
-    signature = privkey.sign(message, padding.PKCS1v15(), hashes.SHA256())
+    signature = privkey.sign(message, RSA_SIGNATURE_PADDING, hashes.SHA256())
     return signature
 
 def sha256_verify(sign: bytes, data: bytes, pubkey: rsa.RSAPublicKey) -> None:
@@ -305,43 +318,30 @@ def sha256_verify(sign: bytes, data: bytes, pubkey: rsa.RSAPublicKey) -> None:
         data (bytes): The data that was signed.
         pubkey (rsa.RSAPublicKey): The RSA public key for verification.
     """
-    pubkey.verify(sign, data, padding.PKCS1v15(), hashes.SHA256())
-    print("auth signature verified\n")
+    pubkey.verify(sign, data, RSA_SIGNATURE_PADDING, hashes.SHA256())
+    logger.debug("auth signature verified")
 
-def serialize_message_for_auth(config_dict: dict, nonce_auth: bytes, nonce_entity: bytes) -> bytearray:
+def serialize_message_for_auth(config_dict: dict, nonce_auth: bytes, nonce_entity: bytes, purpose: str) -> bytes:
     """Serializes message for authentication using given directory and nonce.
 
     Args:
         config_dict (dict): A directory containing filesystem manager data.
         nonce_auth (bytes): Nonce for authentication.
+        nonce_entity (bytes): Nonce of the entity.
+        purpose (str): The purpose of the session key request.
 
     Returns:
-        tuple: A tuple containing the serialized message and nonce entity.
-    """
-    buffer_key_len = 4
-    max_buffer_len = 4
-    message_length = (NONCE_SIZE * 2 + buffer_key_len+len(config_dict["name"]) 
-                                     + len(config_dict["purpose"]) + max_buffer_len * 2)
-    serialize_message = bytearray(message_length)
-    index = 0
-    serialize_message[index:8] = nonce_entity
-    index += NONCE_SIZE
-    serialize_message[index:index+NONCE_SIZE] = nonce_auth
-    index += NONCE_SIZE
-    buffer_key = write_in_n_bytes(int(config_dict["number_key"]), key_size = buffer_key_len)
-    serialize_message[index:index+buffer_key_len] = buffer_key
-    index += buffer_key_len
-    buffer_name_len = num_to_var_length_int(len(config_dict["name"]))
-    serialize_message[index:index+len(buffer_name_len)] = buffer_name_len
-    index += len(buffer_name_len)
-    serialize_message[index:index+len(config_dict["name"])] = bytes.fromhex(str(config_dict["name"]).encode('utf-8').hex())
-    index += len(config_dict["name"])
-    buffer_purpose_len = num_to_var_length_int(len(config_dict["purpose"]))
-    serialize_message[index:+len(buffer_purpose_len)] = buffer_purpose_len
-    index += len(buffer_purpose_len)
-    serialize_message[index:index+len(config_dict["purpose"])] = bytes.fromhex(str(config_dict["purpose"]).encode('utf-8').hex())
-    print(serialize_message)
-    return serialize_message     
+        bytes: The serialized message.
+    """
+    name = config_dict["name"].encode('utf-8')
+    purpose = purpose.encode('utf-8')
+    # Nonces and the 4-byte number of keys form a fixed-layout header.
+    header = AUTH_REQUEST_HEADER.pack(bytes(nonce_entity), bytes(nonce_auth), int(config_dict["number_key"]))
+    serialize_message = b"".join([header,
+                                  num_to_var_length_int(len(name)), name,
+                                  num_to_var_length_int(len(purpose)), purpose])
+    logger.debug("Serialized message for Auth: %s", serialize_message)
+    return serialize_message
 
 def auth_socket_connect(config_dict: dict) -> socket.socket:
     """Establishes a socket connection for authentication.
@@ -351,32 +351,38 @@ def auth_socket_connect(config_dict: dict) -> socket.socket:
 
     Returns:
         socket.socket: The established socket connection.
+
+    Raises:
+        OSError: If Auth cannot be reached within AUTH_CONNECT_TIMEOUT seconds.
     """
     client_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     Host = config_dict["auth_ip_address"]
     Port = int(config_dict["auth_port_number"])
-    client_sock.connect((Host, Port))
+    # Bound the connect so a slow Auth cannot stall the caller indefinitely.
+    client_sock.settimeout(AUTH_CONNECT_TIMEOUT)
+    try:
+        client_sock.connect((Host, Port))
+    except OSError:
+        client_sock.close()
+        raise
     return client_sock
 
-def parse_sessionkey_id(recv: bytearray, config_dict: dict) -> bytes:
-    """Parses session key ID from received data and updates filesystem manager directory.
+def parse_sessionkey_id(recv: bytearray, config_dict: dict) -> tuple:
+    """Parses session key ID from received data and fills it into the purpose template.
 
     Args:
         recv (bytearray): The received data containing the session key ID.
-        config_dict (dict): A directory where the session key ID will be updated.
+        config_dict (dict): A directory with the purpose template, which is left unchanged.
 
     Returns:
-        bytes: The remainder of the received data after extracting the session key ID.
-    """
-    key_id = recv[:SESSION_KEY_ID_SIZE]
-    key_id_int = 0
-    for i in range(SESSION_KEY_ID_SIZE):
-        key_id_int += (int(key_id[i]) << 8*(7-i))
-    # Change key id for purpose
-    config_dict["purpose"] = f'{{"keyId": {str(key_id_int)}}}'
-    print(config_dict["purpose"])
+        tuple: A tuple containing the purpose for the session key ID and the remainder of the received data.
+    """
+    key_id_int = int.from_bytes(recv[:SESSION_KEY_ID_SIZE], 'big')
+    # Fill the key id into the purpose template
+    purpose = config_dict["purpose"].replace(PURPOSE_KEY_ID_PLACEHOLDER, str(key_id_int), 1)
+    logger.debug("Purpose: %s", purpose)
     encrypted_buf = recv[SESSION_KEY_ID_SIZE:]
-    return encrypted_buf
+    return purpose, encrypted_buf
 
 def parse_distributionkey(buffer: bytearray, pubkey: rsa.RSAPublicKey, privkey: rsa.RSAPrivateKey, distribution_key: dict) -> None:
     """Parses distribution key from the buffer using public and private keys.
@@ -395,7 +401,7 @@ def parse_distributionkey(buffer: bytearray, pubkey: rsa.RSAPublicKey, privkey:
     distribution_key["cipher_key"] = plaintext[ABS_VALIDITY_SIZE+1:ABS_VALIDITY_SIZE+1+plaintext[6]]
     distribution_key["mac_key"] = plaintext[ABS_VALIDITY_SIZE+1+1+plaintext[6]:]
 
-def get_session_key(buffer: bytearray, config_dict: dict, sock: socket.socket, distribution_key: dict, session_key: dict, nonce_entity: bytes):
+def get_session_key(buffer: bytearray, config_dict: dict, sock: socket.socket, distribution_key: dict, session_key: dict, nonce_entity: bytes, purpose: str):
     """Handles the process of receiving and processing a session key.
 
     Args:
@@ -405,9 +411,13 @@ def get_session_key(buffer: bytearray, config_dict: dict, sock: socket.socket, d
         distribution_key (dict): The dictionary to store distribution key information.
         session_key (dict): The dictionary to store session key information.
         nonce_entity (bytes): Nonce information.
+        purpose (str): The purpose of the session key request.
 
     Returns:
         None
+
+    Raises:
+        ValueError: If the HMAC or the nonce in Auth's response does not match.
     """
     # Extract message type and length
     msg_type = buffer[0]
@@ -416,15 +426,12 @@ def get_session_key(buffer: bytearray, config_dict: dict, sock: socket.socket, d
     if msg_type == AUTH_HELLO:
         # Handle AUTH_HELLO message
         nonce_auth = buffer[AUTH_ID+1+length_buf:]
-        serialize_message = serialize_message_for_auth(config_dict, nonce_auth, nonce_entity)
+        serialize_message = serialize_message_for_auth(config_dict, nonce_auth, nonce_entity, purpose)
         ciphertext = asymmetric_encrypt(serialize_message, config_dict['pubkey'])
         signature = sha256_sign(ciphertext, config_dict['privkey'])
-        buffer = bytearray(len(ciphertext)+len(signature))
-        buffer[:len(ciphertext)] = ciphertext
-        buffer[len(ciphertext):] = signature
         # Send session key request
-        total_buffer = make_sender_buffer(buffer, SESSION_KEY_REQ_IN_PUB_ENC)
-        sock.send(bytes(total_buffer))
+        total_buffer = make_sender_buffer(b"".join([ciphertext, signature]), SESSION_KEY_REQ_IN_PUB_ENC)
+        sock.sendall(total_buffer)
     elif msg_type == SESSION_KEY_RESP_WITH_DIST_KEY:
         # Handle SESSION_KEY_RESP_WITH_DIST_KEY message
         recv_data = buffer[1+length_buf:]
@@ -441,21 +448,19 @@ def get_session_key(buffer: bytearray, config_dict: dict, sock: socket.socket, d
         
         recv_nonce_entity = decrypted_buf[:NONCE_SIZE]
         if nonce_entity != recv_nonce_entity:
-            print("Failed for communication with Auth")
-            exit()
-        else:    
-            print("Success for communication with Auth")
+            raise ValueError("Failed for communication with Auth: nonce mismatch")
+        logger.debug("Success for communication with Auth")
 
         # Interpret encrypted data
         crypto_buf, crypto_buf_length = var_length_int_to_num(decrypted_buf[NONCE_SIZE:])
         crypto_info = decrypted_buf[NONCE_SIZE+crypto_buf_length:NONCE_SIZE+crypto_buf_length+crypto_buf]
-        print("Crypto Info: ", crypto_info)
+        logger.debug("Crypto Info: %s", crypto_info)
         sessionkey = decrypted_buf[NONCE_SIZE+crypto_buf_length+crypto_buf:]
         number_of_sessionkey = read_unsigned_int_BE(sessionkey, 4)
-        print("Number of session key: ", number_of_sessionkey)
+        logger.debug("Number of session key: %d", number_of_sessionkey)
         parse_sessionkey(sessionkey[4:], session_key)
-        print(session_key)
-        print("Success for receiving the session key.")
+        logger.debug("Session key: %s", session_key)
+        logger.info("Success for receiving the session key.")
 
 def serialize_handshake(nonce: bytearray, reply_nonce: bytearray) -> bytearray:
     """Serializes the handshake data into a bytearray.
@@ -468,7 +473,7 @@ def serialize_handshake(nonce: bytearray, reply_nonce: bytearray) -> bytearray:
         bytearray: The serialized handshake data.
     """
     if (nonce == None) & (reply_nonce == None):
-        print("Error: handshake should include at least one nonce.\n")
+        logger.error("Error: handshake should include at least one nonce.")
 
     indicator = 0
     buffer = bytearray(NONCE_SIZE * 2 + 1)
@@ -484,7 +489,7 @@ def serialize_handshake(nonce: bytearray, reply_nonce: bytearray) -> bytearray:
     buffer[0] = indicator
     return buffer
 
-def make_sender_buffer(buffer: bytearray, msg_type: int) -> bytearray:
+def make_sender_buffer(buffer: bytearray, msg_type: int) -> bytes:
     """Creates a buffer for sending messages.
 
     Args:
@@ -492,17 +497,9 @@ def make_sender_buffer(buffer: bytearray, msg_type: int) -> bytearray:
         msg_type (int): The message type.
 
     Returns:
-        bytearray: The total buffer for sending.
+        bytes: The total buffer for sending.
     """
-    num_buffer = num_to_var_length_int(len(buffer))
-    total_buffer = bytearray(len(num_buffer) + 1 + len(buffer))
-    index = 0
-    total_buffer[index] = msg_type
-    index += 1
-    total_buffer[index:index + len(num_buffer)] = num_buffer
-    index += len(num_buffer)
-    total_buffer[index:] = buffer    
-    return total_buffer
+    return b"".join([bytes((msg_type,)), num_to_var_length_int(len(buffer)), buffer])
 
 def parse_received_message(buffer: bytearray) -> tuple:
     """Parses a received message buffer.
@@ -551,13 +548,15 @@ def concat_data(recv_data: bytearray, file_metadata_table: dict, record_history_
     res_keyid = file_metadata_table["file_keyid"][file_index]
     res_hashvalue = file_metadata_table["hash_value"][file_index]
     command = "ipfs cat $1 > "
-    command = command.replace("$1", res_hashvalue)
-    message = bytearray(3+len(res_keyid)+len(command))
-    message[0] = int(hex(DATA_RESP),16)
-    message[1] = int(hex(len(res_keyid)),16)
-    message[2:2+len(res_keyid)] = res_keyid
-    message[2+len(res_keyid)] = int(hex(len(command)),16)
-    message[3+len(res_keyid):3+len(res_keyid)+len(command)] = bytes.fromhex(str(command).encode('utf-8').hex())
+    command = command.replace("$1", res_hashvalue).encode('utf-8')
+    keyid_len = len(res_keyid)
+    command_len = len(command)
+    message = bytearray(3+keyid_len+command_len)
+    message[0] = DATA_RESP
+    message[1] = keyid_len
+    message[2:2+keyid_len] = res_keyid
+    message[2+keyid_len] = command_len
+    message[3+keyid_len:3+keyid_len+command_len] = command
     record_history_table["name"].append(name), record_history_table["hash_value"].append(res_hashvalue), record_history_table["file_keyid"].append(res_keyid)
     download_list.append(name)
     return message
@@ -612,13 +611,11 @@ def metadata_response(dec_buf: bytearray, file_metadata_table: dict, record_hist
         sequential_num (int): Sequential number.
 
     Returns:
-        bytearray: The response message.
+        bytes: The response message.
     """
     seq_buffer = write_in_n_bytes(sequential_num, SEQ_NUM_SIZE)
     message = concat_data(dec_buf[SEQ_NUM_SIZE:], file_metadata_table, record_history_table, download_list)
-    total_message = bytearray(SEQ_NUM_SIZE + len(message))
-    total_message[:SEQ_NUM_SIZE - 1] = seq_buffer
-    total_message[SEQ_NUM_SIZE:] = message
+    total_message = b"".join([seq_buffer, message])
     enc_buffer = symmetric_encrypt_hmac(session_key, total_message)
     return make_sender_buffer(enc_buffer, SECURE_COMM_MSG)
 
@@ -634,7 +631,7 @@ def dict_to_tuple(metadata_dict: dict) -> list:
     """
     tuple_list = []
     for i, name in enumerate(metadata_dict['name']):
-        key_id_int = sum(int(byte) << (8 * (7-j)) for j, byte in enumerate(metadata_dict['file_keyid'][i]))
+        key_id_int = int.from_bytes(metadata_dict['file_keyid'][i], 'big')
         tuple_list.append((name, key_id_int, metadata_dict['hash_value'][i]))
     return tuple_list
 
@@ -727,11 +724,7 @@ def database_to_dict(data: str, dict: dict) -> dict:
     Returns:
         dict: The updated dictionary with database data.
     """
-    key_id_int = int(data[1])
-    key_id_bytes = bytearray(SESSION_KEY_ID_SIZE)
-    for k in range(SESSION_KEY_ID_SIZE):
-        key_id_bytes[k] = key_id_int >> 8 * (7-k)
-        key_id_int -= key_id_bytes[k] << 8 * (7-k)
+    key_id_bytes = int(data[1]).to_bytes(SESSION_KEY_ID_SIZE, 'big')
     dict['name'].append(data[0])
     dict['file_keyid'].append(key_id_bytes)
     dict['hash_value'].append(data[2])
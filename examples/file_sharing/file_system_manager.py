@@ -1,7 +1,6 @@
 import socket
 import selectors
 import types
-from datetime import datetime
 
 
 bytes_num = 1024
@@ -36,7 +35,7 @@ def concat_data(recv_data):
     message[1] = int(hex(len(res_keyid)),16)
     message[2:2+len(res_keyid)] = res_keyid
     message[2+len(res_keyid)] = int(hex(len(command)),16)
-    message[3+len(res_keyid):3+len(res_keyid)+len(command)] = bytes.fromhex(str(command).encode('utf-8').hex())
+    message[3+len(res_keyid):3+len(res_keyid)+len(command)] = command.encode('utf-8')
     log_center["name"].append(name), log_center["hash_value"].append(res_hashvalue), log_center["keyid"].append(res_keyid)
     download_list.append(name)
     return message
@@ -1,14 +1,30 @@
 # from iotauth.entity.python import entity_server
+import collections
+import logging
 import selectors
 import sys
 import socket
 import os
 import types
 import secrets
+from concurrent.futures import ThreadPoolExecutor
 print(os.path.dirname(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))) +"/entity/python")
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(os.path.dirname(__file__)))) +"/entity/python")
 import entity_server
 
+logger = logging.getLogger(__name__)
+
+# Kinds of connections registered with the selector
+ENTITY_CONNECTION = "entity"
+AUTH_CONNECTION = "auth"
+WAKEUP_CONNECTION = "wakeup"
+# Stages of a session key request to Auth
+WAITING_AUTH_HELLO = "waiting_auth_hello"
+WAITING_SESSION_KEY = "waiting_session_key"
+# Message type expected from Auth in each stage of a session key request
+AUTH_STAGE_MSG_TYPES = {WAITING_AUTH_HELLO: entity_server.AUTH_HELLO,
+                        WAITING_SESSION_KEY: entity_server.SESSION_KEY_RESP_WITH_DIST_KEY}
+
 def accept_wrapper(sock):
     """Accepts a connection and performs necessary setup.
 
@@ -19,17 +35,154 @@ def accept_wrapper(sock):
         None
     """
     conn, addr = sock.accept()
-    print(f"Accepted connection from {addr}")
+    logger.info("Accepted connection from %s", addr)
     conn.setblocking(False)
 
-    # Setup data for the connection
-    data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
+    # Setup data for the connection, with a receive buffer reused for every read.
+    # The session key is set once handshake1 has been matched to a key.
+    buf = bytearray(entity_server.READ_BYTES_NUM)
+    data = types.SimpleNamespace(kind=ENTITY_CONNECTION, addr=addr, inb=b"", outb=b"", buf=buf, view=memoryview(buf), session_key=None)
     events = selectors.EVENT_READ | selectors.EVENT_WRITE
 
     # Register the connection with the selector
     node_selector.register(conn, events, data=data)
 
 
+def send_handshake2(sock, session_key, encrypted_buf):
+    """Decrypts handshake1 with the session key and replies with handshake2.
+
+    Args:
+        sock (socket.socket): The socket connected to the entity.
+        session_key (dict): The session key of the entity connection.
+        encrypted_buf (bytes): The encrypted part of handshake1.
+
+    Returns:
+        None
+    """
+    # Decrypt the buffer using the session key
+    mac_index = len(encrypted_buf) - entity_server.MAC_KEY_SIZE
+    try:
+        dec_buf = entity_server.symmetric_decrypt_hmac(session_key, encrypted_buf[:mac_index], encrypted_buf[mac_index:])
+    except ValueError as e:
+        logger.error("Failed to decrypt handshake1: %s", e)
+        close_entity_connection(sock)
+        return
+    # Handshake2
+    nonce_entity = dec_buf[1:]
+    nonce_server = secrets.token_bytes(entity_server.NONCE_SIZE)
+    logger.debug("nonce_server: %s", nonce_server)
+    serialized_buffer = entity_server.serialize_handshake(nonce_server, nonce_entity)
+    logger.debug("serialized_buffer: %s", serialized_buffer)
+    enc_buffer = entity_server.symmetric_encrypt_hmac(session_key, serialized_buffer)
+    total_buffer = entity_server.make_sender_buffer(enc_buffer, entity_server.SKEY_HANDSHAKE_2)
+    sock.sendall(total_buffer)
+
+
+def close_entity_connection(sock):
+    """Closes an entity connection whose handshake cannot be completed.
+
+    Args:
+        sock (socket.socket): The socket connected to the entity.
+
+    Returns:
+        None
+    """
+    try:
+        node_selector.unregister(sock)
+    except (KeyError, ValueError):
+        # The entity has already closed its side of the connection.
+        pass
+    sock.close()
+
+
+def service_auth_connection(key, mask):
+    """Services a connection to Auth that requests the session key for a pending handshake.
+
+    Args:
+        key (selectors.SelectEvent): The key associated with the Auth socket.
+        mask (int): The event mask.
+
+    Returns:
+        None
+    """
+    auth_sock = key.fileobj
+    data = key.data
+
+    if not (mask & selectors.EVENT_READ):
+        return
+
+    # Receive data from the authentication server
+    recv_size = auth_sock.recv_into(data.buf)
+    # Auth closed the connection before the session key arrived
+    if not recv_size:
+        logger.warning("Auth closed connection %s in stage %s", data.addr, data.stage)
+        node_selector.unregister(auth_sock)
+        auth_sock.close()
+        close_entity_connection(data.entity_sock)
+        return
+    # The RSA work runs on a worker thread, so copy the message out of the shared buffer.
+    recv_data_from_auth = bytes(data.view[:recv_size])
+    # Stop watching the socket until the worker has processed this message.
+    node_selector.unregister(auth_sock)
+    if recv_data_from_auth[0] != AUTH_STAGE_MSG_TYPES[data.stage]:
+        logger.error("Unexpected message type %d from Auth in stage %s", recv_data_from_auth[0], data.stage)
+        auth_sock.close()
+        close_entity_connection(data.entity_sock)
+        return
+    future = crypto_executor.submit(entity_server.get_session_key, recv_data_from_auth, file_manager_dict, auth_sock,
+                                    data.distribution_key, data.session_key, data.nonce_auth, data.purpose)
+    future.add_done_callback(lambda future: notify_crypto_done(auth_sock, data, future))
+
+
+def notify_crypto_done(auth_sock, data, future):
+    """Queues a finished session key job and wakes up the selector loop.
+
+    Called on the worker thread once the job is done.
+
+    Args:
+        auth_sock (socket.socket): The socket connected to Auth.
+        data (types.SimpleNamespace): The state of the pending handshake.
+        future (concurrent.futures.Future): The finished job.
+
+    Returns:
+        None
+    """
+    finished_crypto_jobs.append((auth_sock, data, future))
+    wakeup_send_sock.send(b"\0")
+
+
+def finish_crypto_jobs():
+    """Continues the handshakes whose session key jobs have finished on worker threads.
+
+    Returns:
+        None
+    """
+    wakeup_recv_sock.recv(entity_server.READ_BYTES_NUM)
+    while finished_crypto_jobs:
+        auth_sock, data, future = finished_crypto_jobs.popleft()
+        try:
+            future.result()
+        except Exception as e:
+            logger.error("Failed to get the session key from Auth: %r", e)
+            auth_sock.close()
+            close_entity_connection(data.entity_sock)
+            continue
+        if data.stage == WAITING_AUTH_HELLO:
+            # The session key request was sent, wait for Auth's response
+            data.stage = WAITING_SESSION_KEY
+            node_selector.register(auth_sock, selectors.EVENT_READ, data=data)
+        elif data.session_key["sessionkey_id"] == data.sessionkey_id:
+            # Close the Auth socket and finish the handshake with the entity
+            auth_sock.close()
+            known_session_keys[data.sessionkey_id] = data.session_key
+            data.entity_data.session_key = data.session_key
+            send_handshake2(data.entity_sock, data.session_key, data.encrypted_buf)
+        else:
+            logger.error("Auth did not return the requested session key")
+            auth_sock.close()
+            close_entity_connection(data.entity_sock)
+
+
 def service_connection(key, mask):
     """Services an existing connection based on the specified events.
 
@@ -48,66 +201,70 @@ def service_connection(key, mask):
     if not (mask & selectors.EVENT_READ):
         return
         
-    # Attempt to receive data from the socket
-    recv_data = sock.recv(entity_server.READ_BYTES_NUM)
+    # Attempt to receive data from the socket into the connection's buffer
+    recv_size = sock.recv_into(data.buf)
     # Check for a closed connection
-    if not recv_data:
-        print(f"Closing connection to {data.addr}")
+    if not recv_size:
+        logger.info("Closing connection to %s", data.addr)
         node_selector.unregister(sock)
         return
+    # Slices of recv_data share data.buf, so copy anything kept past this call.
+    recv_data = data.view[:recv_size]
     msg_type, received_message = entity_server.parse_received_message(recv_data)
+    # The HMAC tag is at the end of every encrypted message
+    mac_index = len(received_message) - entity_server.MAC_KEY_SIZE
     # Check for a specific indicator in the received data
     if msg_type == entity_server.SKEY_HANDSHAKE_1:
-        print("received session key handshake1!\n")
+        logger.info("received session key handshake1!")
         # Perform session key handshake
-        encrypted_buf = entity_server.parse_sessionkey_id(received_message, file_manager_dict)
-        client_sock = entity_server.auth_socket_connect(file_manager_dict)
-        nonce_auth = secrets.token_bytes(entity_server.NONCE_SIZE)
-
-        while True:
-            # Check if we have the expected session key
-            if comm_session_key["sessionkey_id"] == received_message[:entity_server.NONCE_SIZE]:
-                print("We have the session key...!!")
-                client_sock.close()
-                # Decrypt the buffer using the session key
-                dec_buf = entity_server.symmetric_decrypt_hmac(comm_session_key, encrypted_buf[:len(encrypted_buf)-entity_server.MAC_KEY_SIZE], encrypted_buf[len(encrypted_buf)-entity_server.MAC_KEY_SIZE:])
-                # Handshake2
-                nonce_entity = dec_buf[1:]
-                nonce_server = secrets.token_bytes(entity_server.NONCE_SIZE)
-                print("nonce_server: ")
-                print(nonce_server)
-                serialized_buffer = entity_server.serialize_handshake(nonce_server, nonce_entity)
-                print("serialized_buffer: ")
-                print(serialized_buffer)
-                enc_buffer = entity_server.symmetric_encrypt_hmac(comm_session_key, serialized_buffer)
-                total_buffer = entity_server.make_sender_buffer(enc_buffer, entity_server.SKEY_HANDSHAKE_2)
-                sock.send(bytes(total_buffer))
-                # Close the client socket and exit the loop
-                break
-            # Receive data from the authentication server
-            recv_data_from_auth = client_sock.recv(entity_server.READ_BYTES_NUM)
-            # Continue the loop if no data received
-            if len(recv_data_from_auth) == 0:
-                continue
-            # Process the received data to get the session key
-            entity_server.get_session_key(recv_data_from_auth, file_manager_dict, client_sock, distribution_key, comm_session_key, nonce_auth)
+        purpose, encrypted_buf = entity_server.parse_sessionkey_id(received_message, file_manager_dict)
+        # Reuse the session key we already have instead of asking Auth again.
+        sessionkey_id = bytes(received_message[:entity_server.NONCE_SIZE])
+        if sessionkey_id in known_session_keys:
+            logger.debug("We have the session key...!!")
+            data.session_key = known_session_keys[sessionkey_id]
+            send_handshake2(sock, data.session_key, encrypted_buf)
+        else:
+            try:
+                client_sock = entity_server.auth_socket_connect(file_manager_dict)
+            except OSError as e:
+                logger.error("Failed to connect to Auth: %s", e)
+                close_entity_connection(sock)
+                return
+            # Wait for Auth through the selector so that other connections are not blocked.
+            # The socket keeps the connect timeout, so sendall on a worker thread blocks up to that timeout.
+            auth_buf = bytearray(entity_server.READ_BYTES_NUM)
+            auth_data = types.SimpleNamespace(kind=AUTH_CONNECTION, addr=client_sock.getpeername(), stage=WAITING_AUTH_HELLO, entity_sock=sock,
+                                              entity_data=data, sessionkey_id=sessionkey_id, encrypted_buf=bytes(encrypted_buf), purpose=purpose,
+                                              nonce_auth=secrets.token_bytes(entity_server.NONCE_SIZE), buf=auth_buf, view=memoryview(auth_buf),
+                                              distribution_key=dict.fromkeys(distribution_key_fields, ""), session_key=dict.fromkeys(session_key_fields, ""))
+            node_selector.register(client_sock, selectors.EVENT_READ, data=auth_data)
 
+    if msg_type in (entity_server.SKEY_HANDSHAKE_3, entity_server.SECURE_COMM_MSG):
+        if data.session_key is None:
+            logger.error("Received message type %d from %s before a session key was set", msg_type, data.addr)
+            close_entity_connection(sock)
+            return
+        try:
+            dec_buf = entity_server.symmetric_decrypt_hmac(data.session_key, received_message[:mac_index], received_message[mac_index:])
+        except ValueError as e:
+            logger.error("Failed to decrypt message type %d from %s: %s", msg_type, data.addr, e)
+            close_entity_connection(sock)
+            return
     if msg_type == entity_server.SKEY_HANDSHAKE_3:
-        dec_buf = entity_server.symmetric_decrypt_hmac(comm_session_key, received_message[:len(received_message)-entity_server.MAC_KEY_SIZE], received_message[len(received_message)-entity_server.MAC_KEY_SIZE:])
-        print("received session key handshake3!\n")
+        logger.info("received session key handshake3!")
     if msg_type == entity_server.SECURE_COMM_MSG:
-        print("Received secure message!!")
-        dec_buf = entity_server.symmetric_decrypt_hmac(comm_session_key, received_message[:len(received_message)-entity_server.MAC_KEY_SIZE], received_message[len(received_message)-entity_server.MAC_KEY_SIZE:])
+        logger.debug("Received secure message!!")
         seq_num = entity_server.read_int_from_buf(dec_buf, entity_server.SEQ_NUM_SIZE)
-        print("Received sequential number:", seq_num)
-        print("Decrypted message:", dec_buf[entity_server.SEQ_NUM_SIZE:])
+        logger.debug("Received sequential number: %d", seq_num)
+        logger.debug("Decrypted message: %s", dec_buf[entity_server.SEQ_NUM_SIZE:])
         if dec_buf[entity_server.SEQ_NUM_SIZE] == entity_server.DATA_UPLOAD_REQ:
             entity_server.save_info_for_file(dec_buf[entity_server.SEQ_NUM_SIZE:], file_metadata_table)
-            print(file_metadata_table)
+            logger.debug("File metadata table: %s", file_metadata_table)
         elif dec_buf[entity_server.SEQ_NUM_SIZE] == entity_server.DATA_DOWNLOAD_REQ:
                 total_buffer = entity_server.metadata_response(dec_buf, file_metadata_table, 
-                                                           record_history_table, download_list, comm_session_key, sequential_num)
-                sock.send(bytes(total_buffer))
+                                                           record_history_table, download_list, data.session_key, sequential_num)
+                sock.sendall(total_buffer)
                 sequential_num += 1
 
 # Check number of arguments
@@ -120,10 +277,15 @@ Usage:  python3 secure_filesystem_manager.py file_system_manager.config
 """)
     sys.exit(0)
 
+# Per-handshake details are logged at DEBUG level and skipped by default.
+logging.basicConfig(level=logging.INFO, format="%(message)s")
+
 # Setting directories for config, distribution key, and session key
 file_manager_dict = {"name" : "", "purpose" : '', "number_key":"", "auth_pubkey_path":"", "privkey_path":"", "auth_ip_address":"", "auth_port_number":"", "port_number":"", "ip_address":"", "network_protocol":"", "pubkey": "", "privkey": ""}
-distribution_key = {"abs_validity" : "", "cipher_key" : "", "mac_key" : ""}
-comm_session_key = {"sessionkey_id" : "", "abs_validity" : "", "rel_validity" : "", "cipher_key" : "", "mac_key" : ""}
+distribution_key_fields = ("abs_validity", "cipher_key", "mac_key")
+session_key_fields = ("sessionkey_id", "abs_validity", "rel_validity", "cipher_key", "mac_key")
+# Session keys received from Auth by session key id, reused when another entity connects with the same key
+known_session_keys = {}
 
 # Setting directories for managing information of the file
 file_metadata_table = {"name":[] , "file_keyid" : [], "hash_value" : []}
@@ -134,11 +296,22 @@ download_list = []
 entity_server.load_config(sys.argv[1], file_manager_dict)
 file_manager_dict["pubkey"] = entity_server.load_pubkey(file_manager_dict["auth_pubkey_path"])
 file_manager_dict["privkey"] = entity_server.load_privkey(file_manager_dict["privkey_path"])
+# Report whether RSA/AES can use the OpenSSL assembly and hardware AES code paths.
+if not entity_server.check_crypto_acceleration():
+    logger.info("Secure messages will use software AES; RSA work in session key handshakes is not affected.")
 
 sequential_num = 0
 
 node_selector = selectors.DefaultSelector()
 
+# RSA work for session key requests runs on worker threads; cryptography releases the GIL inside OpenSSL.
+# Workers queue finished jobs and write to the wakeup socket so the selector loop picks them up.
+crypto_executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+finished_crypto_jobs = collections.deque()
+wakeup_recv_sock, wakeup_send_sock = socket.socketpair()
+wakeup_recv_sock.setblocking(False)
+node_selector.register(wakeup_recv_sock, selectors.EVENT_READ, data=types.SimpleNamespace(kind=WAKEUP_CONNECTION))
+
 host, port = file_manager_dict["ip_address"], int(file_manager_dict["port_number"])
 
 manager_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -155,6 +328,10 @@ try:
         for key, mask in events:
             if key.data is None:
                 accept_wrapper(key.fileobj)
+            elif key.data.kind == WAKEUP_CONNECTION:
+                finish_crypto_jobs()
+            elif key.data.kind == AUTH_CONNECTION:
+                service_auth_connection(key, mask)
             else:
                 service_connection(key, mask)
 except KeyboardInterrupt:
@@ -162,5 +339,8 @@ except KeyboardInterrupt:
 finally:
     manager_socket.close()
     node_selector.close()
+    crypto_executor.shutdown()
+    wakeup_recv_sock.close()
+    wakeup_send_sock.close()
     entity_server.create_encrypt_database(entity_server.database_name, password, file_metadata_table, record_history_table)
     print("Finished")